@@ -7,12 +7,11 @@ from firebase_admin import credentials, initialize_app
 from flask_cors import CORS
 from random_word import RandomWords
 
-from routes.chat import chat_bp
-
-
-# Load environment variables
+# Load environment variables before importing modules that read them at import time
 load_dotenv()
 
+from routes.chat import chat_bp
+
 # Initialize Flask app
 app = Flask(__name__)
 
@@ -1,7 +1,9 @@
+import json
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
-from flask import Blueprint, request, jsonify, Response
-from vertexai.generative_models import Part, Tool
+from flask import Blueprint, request, jsonify, Response, stream_with_context
+from vertexai.generative_models import Part
 
 import src.anthropic.generate as anthropic_generate
 import src.chat.agent_chat as perform_agent_chat
@@ -9,13 +11,20 @@ import src.routes.utils as endpoint_utils
 import src.remote_config.utils as remote_config_utils
 from src.chat.utils import (
     clean_text,
-    get_config_and_prompt,
-    create_function_declaration
+    get_chat_history,
+    get_citations_tool,
+    get_config_and_prompt
 )
 
 
 chat_bp = Blueprint('chat', __name__, url_prefix='/chat')
 
+# Message sent by the frontend to run the full claims and imprecise language workflow
+_WORKFLOW_TRIGGER = "Please find all medical claims and instances of imprecise language. Be thorough and complete."
+
+# Executor for fetching prompts and tools while the request thread reads chat history
+_prefetch_executor = ThreadPoolExecutor(max_workers=8)
+
 
 @chat_bp.route("", methods=["POST"])
 def chat():
@@ -41,6 +50,7 @@ def chat():
     message_id = data.get("message_id", data.get("messageId"))
     system_instruction = data.get("system_instruction", data.get("systemInstruction"))
     style_mode = data.get("style_mode", data.get("styleMode"))
+    engage_workflow = data.get("engage_workflow", data.get("engageWorkflow"))
 
     # Check for uploaded media
     uploaded_files = endpoint_utils.check_uploaded_media(user_id, chat_history_id, message_id)
@@ -53,6 +63,7 @@ def chat():
         'message_id': message_id,
         'system_instruction': system_instruction,
         'style_mode': style_mode,
+        'engage_workflow': engage_workflow,
         'uploaded_files': uploaded_files
     }
 
@@ -84,39 +95,23 @@ def task_chat():
                 mime_type=uploaded_file["fileMimeType"])
         )
 
-    engage_workflow = False
-    if "Please find all medical claims and instances of imprecise language. Be thorough and complete." in text:
-        engage_workflow = True
+    # Prefer the explicit flag; only scan the text when the client did not send one
+    engage_workflow = data.get('engage_workflow')
+    if engage_workflow is None:
+        engage_workflow = _WORKFLOW_TRIGGER in text
     contents.append(Part.from_text(text))
 
-    try:
-        # Fetch role prompt
-        role_prompt = get_config_and_prompt("role_prompt")
-
-        # Fetch verification prompt
-        verification_prompt = get_config_and_prompt("verification_prompt")
-
-        # Define functions
-        # Identify medical claims
-        identify_medical_claims_function = create_function_declaration(
-            "medical_claims_identification",
-            "identify_medical_claims_multi_function_description",
-            "identify_medical_claims_multi_function_parameters"
-        )
-
-        # Identify imprecise language
-        identify_imprecise_language_function = create_function_declaration(
-            "imprecise_language_identification",
-            "identify_imprecise_language_multi_function_description",
-            "identify_imprecise_language_multi_function_parameters"
-        )
+    # Prompts and function declarations are cached, so they only hit the network when cold.
+    # Chat history is read on this thread so it never queues behind other requests' work.
+    role_prompt_future = _prefetch_executor.submit(get_config_and_prompt, "role_prompt")
+    verification_prompt_future = _prefetch_executor.submit(get_config_and_prompt, "verification_prompt")
+    citations_tool_future = _prefetch_executor.submit(get_citations_tool)
 
-        citations_tool = Tool(
-            function_declarations=[
-                identify_imprecise_language_function,
-                identify_medical_claims_function,
-            ],
-        )
+    try:
+        chat_history = get_chat_history(user_id, chat_history_id)
+        role_prompt = role_prompt_future.result()
+        verification_prompt = verification_prompt_future.result()
+        citations_tool = citations_tool_future.result()
 
         # Generate chat response
         output_text, _, processed_claims, processed_imprecise_language_instances = perform_agent_chat.generate_text(
@@ -127,6 +122,7 @@ def task_chat():
             engage_workflow=engage_workflow,
             user_id=user_id,
             chat_history_id=chat_history_id,
+            chat_history=chat_history,
             tools=[citations_tool],
         )
 
@@ -183,6 +179,19 @@ def get_chat_title():
 
         # Generate chat title
         prompt = prompt.format(input_text=text)
+
+        # Stream the title as server-sent events when the client asks for it
+        if data.get('stream'):
+            def generate_events():
+                try:
+                    for text_chunk in anthropic_generate.stream(prompt=prompt):
+                        yield f"data: {json.dumps({'text': text_chunk})}\n\n"
+                    yield "event: done\ndata: {}\n\n"
+                except Exception as e:
+                    yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+
+            return Response(stream_with_context(generate_events()), mimetype='text/event-stream')
+
         generated_title = anthropic_generate.generate(prompt=prompt)
         return jsonify({'title': generated_title})
     except Exception as e:
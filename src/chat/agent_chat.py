@@ -1,22 +1,74 @@
+import asyncio
 import os
-import vertexai
-import vertexai.preview.generative_models as generative_models
 from vertexai.generative_models import (
+    Content,
     GenerationConfig,
     GenerativeModel,
     Part,
     Tool,
     ToolConfig
 )
-from typing import Any, Dict, List, Optional
+from concurrent.futures import Future
+from functools import lru_cache
+from google.protobuf import json_format
+from typing import Any, Dict, List, Optional, Tuple
 from uuid import uuid4
 from vertexai.preview.generative_models import grounding
 
 import src.routes.utils as endpoint_utils
 from src.chat.multithreaded import TextGenerator
-from src.chat.utils import get_chat_history, save_chat_history
+from src.chat.utils import SAFETY_SETTINGS, get_chat_history, init_vertexai, run_async, save_chat_history
 from src.claims_analysis.processing import structure_claims_analysis
 
+DEFAULT_GENERATION_CONFIG = GenerationConfig(temperature=0.2)
+
+GOOGLE_SEARCH_TOOL = Tool.from_google_search_retrieval(
+    google_search_retrieval=grounding.GoogleSearchRetrieval()
+)
+
+# Per-call tool configs forcing each workflow branch to call its own function
+MEDICAL_CLAIMS_TOOL_CONFIG = ToolConfig(
+    function_calling_config=ToolConfig.FunctionCallingConfig(
+        mode=ToolConfig.FunctionCallingConfig.Mode.ANY,
+        allowed_function_names=["medical_claims_identification"],
+    ))
+IMPRECISE_LANGUAGE_TOOL_CONFIG = ToolConfig(
+    function_calling_config=ToolConfig.FunctionCallingConfig(
+        mode=ToolConfig.FunctionCallingConfig.Mode.ANY,
+        allowed_function_names=["imprecise_language_identification"],
+    ))
+
+
+def get_function_call_args(part: Part) -> Dict[str, Any]:
+    """Convert the arguments of a function call part to plain Python objects in one pass."""
+    return json_format.MessageToDict(part.function_call._pb).get('args', {})
+
+
+@lru_cache(maxsize=32)
+def get_model(
+    model_name: str,
+    system_instruction: Optional[str],
+    safety_settings: Tuple,
+    tools: Tuple[Tool, ...] = ()
+) -> GenerativeModel:
+    """Get a GenerativeModel, reusing instances built with the same configuration."""
+    return GenerativeModel(
+        model_name,
+        system_instruction=None if not system_instruction else [system_instruction],
+        generation_config=DEFAULT_GENERATION_CONFIG,
+        safety_settings=dict(safety_settings),
+        tools=list(tools) or None
+    )
+
+
+def _to_user_content(prompt) -> Content:
+    """Wrap a prompt of text and/or Parts as a user Content."""
+    prompts = prompt if isinstance(prompt, list) else [prompt]
+    return Content(
+        role="user",
+        parts=[part if isinstance(part, Part) else Part.from_text(part) for part in prompts]
+    )
+
 
 def generate_text(
     prompt,
@@ -33,98 +85,41 @@ def generate_text(
     location: str = "us-central1",
     model_name: str = "gemini-1.5-pro-002",
     temperature: int = 0,
-    max_output_tokens: int = 8192
+    max_output_tokens: int = 8192,
+    chat_history: Optional[List[Content]] = None
 ):
     """Generate text."""
-    vertexai.init(project=project_id, location=location)
+    init_vertexai(project_id, location)
 
     if not tools:
         tools = []
 
     if not safety_settings:
-        safety_settings = {
-            generative_models.HarmCategory.HARM_CATEGORY_HATE_SPEECH: generative_models.HarmBlockThreshold.BLOCK_NONE,
-            generative_models.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: generative_models.HarmBlockThreshold.BLOCK_NONE,
-            generative_models.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: generative_models.HarmBlockThreshold.BLOCK_NONE,
-            generative_models.HarmCategory.HARM_CATEGORY_HARASSMENT: generative_models.HarmBlockThreshold.BLOCK_NONE,
-        }
-
-    # Determine chat history
+        safety_settings = SAFETY_SETTINGS
+    safety_settings_key = tuple(safety_settings.items())
+
+    # Determine chat history, unless the caller already fetched it
     if chat_history_id:
-        chat_history = get_chat_history(user_id, chat_history_id)
+        if chat_history is None:
+            chat_history = get_chat_history(user_id, chat_history_id)
     else:
         chat_history_id, chat_history = str(uuid4()), []
+    # Chat sessions extend the history list in place, so remember what is already stored
+    stored_history_length = len(chat_history)
 
-    # Initialize medical claims model
-    if engage_workflow:
-        tool_config = ToolConfig(
-            function_calling_config=ToolConfig.FunctionCallingConfig(
-                mode=ToolConfig.FunctionCallingConfig.Mode.ANY,
-                allowed_function_names=["medical_claims_identification"],
-            ))
-    else:
-        tool_config = ToolConfig(
-            function_calling_config=ToolConfig.FunctionCallingConfig(
-                mode=ToolConfig.FunctionCallingConfig.Mode.AUTO,
-            ))
-    medical_claims_model_instance = GenerativeModel(
-        model_name,
-        system_instruction=None if not system_instruction else [system_instruction],
-        generation_config=GenerationConfig(
-            temperature=0.2,
-        ),
-        safety_settings=safety_settings,
-        tools=tools,
-        tool_config=tool_config
-    )
-
-    # Initialize imprecise language model
-    if engage_workflow:
-        tool_config = ToolConfig(
-            function_calling_config=ToolConfig.FunctionCallingConfig(
-                mode=ToolConfig.FunctionCallingConfig.Mode.ANY,
-                allowed_function_names=["imprecise_language_identification"],
-            ))
-    else:
-        tool_config = ToolConfig(
-            function_calling_config=ToolConfig.FunctionCallingConfig(
-                mode=ToolConfig.FunctionCallingConfig.Mode.AUTO,
-            ))
-    imprecise_language_model_instance = GenerativeModel(
-        model_name,
-        system_instruction=None if not system_instruction else [system_instruction],
-        generation_config=GenerationConfig(
-            temperature=0.2,
-        ),
-        safety_settings=safety_settings,
-        tools=tools,
-        tool_config=tool_config
-    )
+    # Initialize function calling model; the workflow narrows the allowed function per call
+    function_calling_model_instance = get_model(model_name, system_instruction, safety_settings_key, tools=tuple(tools))
 
     # Initialize grounding model
-    grounding_model_instance = GenerativeModel(
+    grounding_model_instance = get_model(
         model_name,
-        system_instruction=None if not system_instruction else [system_instruction],
-        generation_config=GenerationConfig(
-            temperature=0.2,
-        ),
-        safety_settings=safety_settings,
-        tools=[
-            Tool.from_google_search_retrieval(
-                google_search_retrieval=grounding.GoogleSearchRetrieval()
-            )
-        ]
+        system_instruction,
+        safety_settings_key,
+        tools=(GOOGLE_SEARCH_TOOL,)
     )
 
     # Initialize output response model
-    output_response_model_instance = GenerativeModel(
-        model_name,
-        system_instruction=None if not system_instruction else [system_instruction],
-        generation_config=GenerationConfig(
-            temperature=0.2,
-        ),
-        safety_settings=safety_settings
-    )
+    output_response_model_instance = get_model(model_name, system_instruction, safety_settings_key)
 
     # Initialize multithreading text generator
     text_generator = TextGenerator(
@@ -137,146 +132,276 @@ def generate_text(
 
     # Initialize tracking variables
     loop_count = 0
-    output_text, error_message = "", ""
+    output_text = ""
     processed_imprecise_language_instances = None
     processed_claims = None
+    pending_updates = []
     try:
-        # Send initial message
-        chat = medical_claims_model_instance.start_chat(history=chat_history, response_validation=False)
-        response = chat.send_message(prompt)
-
-        break_loop = False
-        while True:
-            response_parts = []
-            processing_parts = response.candidates[0].content.parts
-            for part in processing_parts:
-                function_call_name = part.function_call.name
-                if not function_call_name:
-                    # Direct text response
-                    output_text = part.text
-                    break_loop = True
-                    break
-                elif function_call_name == 'imprecise_language_identification':
-                    try:
-                        # Handle imprecise language identification request
-                        args = dict(part.function_call.args)
-                        rc_to_json_array = lambda repeated_composite: [dict(item) for item in repeated_composite]
-                        identified_instances_data = rc_to_json_array(args.get('identified_instances', []))
-                        processed_imprecise_language_instances = identified_instances_data
-
-                        if processed_imprecise_language_instances:
-                            for processed_instance in processed_imprecise_language_instances:
-                                processed_instance["id"] = str(uuid4())
-
-                        # Partial update with imprecise language instances
-                        endpoint_utils.update_firestore(
-                            user_id,
-                            chat_history_id,
-                            style_mode,
-                            processed_imprecise_language_instances=processed_imprecise_language_instances
-                        )
-
-                        api_response = "Processed all imprecise language identified."
-                        if engage_workflow:
-                            next_steps_instruction = (
-                                "Respond that the input text has been processed and summarize the findings. "
-                                "Ask if the user needs help understanding the findings or would like to know more "
-                                "about any finding in particular."
-                            )
-                        else:
-                            next_steps_instruction = "Proceed"
-                        response_part = Part.from_function_response(
-                            name=function_call_name,
-                            response={
-                                "content": api_response,
-                                "processed_imprecise_language_instances": processed_imprecise_language_instances,
-                                "next_steps_instruction": next_steps_instruction
-                            },
-                        )
-                        response_parts.append(response_part)
+        if engage_workflow:
+            # Identify claims and imprecise language concurrently, then respond once
+            chat, output_text, processed_claims, processed_imprecise_language_instances = _run_workflow(
+                prompt=prompt,
+                chat_history=chat_history,
+                function_calling_model_instance=function_calling_model_instance,
+                output_response_model_instance=output_response_model_instance,
+                text_generator=text_generator,
+                verification_prompt=verification_prompt,
+                user_id=user_id,
+                chat_history_id=chat_history_id,
+                style_mode=style_mode,
+                pending_updates=pending_updates
+            )
+        else:
+            # Send initial message
+            chat = function_calling_model_instance.start_chat(history=chat_history, response_validation=False)
+            response = chat.send_message(prompt)
 
-                        if len(response_parts) < len(processing_parts):
-                            continue
-                    except Exception as e:
-                        # Handle any errors that occurred during the request
-                        local_error_message = f"Error when Identifying Imprecise Language: {str(e)}"
-                        error_message += f"\n{local_error_message}"
-                        response_part = Part.from_function_response(
-                            name=function_call_name,
-                            response={
-                                "error": local_error_message,
-                                "instructions": "Error occurred while identifying imprecise language. Please try again."},
+            break_loop = False
+            while True:
+                response_parts = []
+                processing_parts = response.candidates[0].content.parts
+                for part in processing_parts:
+                    function_call_name = part.function_call.name
+                    if not function_call_name:
+                        # Direct text response
+                        output_text = part.text
+                        break_loop = True
+                        break
+                    elif function_call_name == 'imprecise_language_identification':
+                        response_part, instances = _process_imprecise_language(
+                            part, "Proceed", user_id, chat_history_id, style_mode, pending_updates
                         )
+                        processed_imprecise_language_instances = instances or processed_imprecise_language_instances
                         response_parts.append(response_part)
-                elif 'medical_claims_identification':
-                    try:
-                        # Handle medical claims identification request
-                        args = dict(part.function_call.args)
-                        rc_to_json_array = lambda repeated_composite: [dict(item) for item in repeated_composite]
-                        identified_claims_data = rc_to_json_array(args.get('identified_claims', []))
-
-                        claims = [identified_claim["claim"] for identified_claim in identified_claims_data]
-                        prompts = [verification_prompt.format(input_claim=claim) for claim in claims]
-                        results = text_generator.generate_texts(prompts, num_threads=8)
-                        structured_claims_results = [structure_claims_analysis(result.to_dict()) for result in results]
-                        claims_data = [{**claim_data, **structured_claims_result} for claim_data, structured_claims_result
-                                       in zip(identified_claims_data, structured_claims_results)]
-                        processed_claims = claims_data
-
-                        if processed_claims:
-                            for processed_claim in processed_claims:
-                                processed_claim["id"] = str(uuid4())
-
-                        # Partial update with processed claims
-                        endpoint_utils.update_firestore(
-                            user_id,
-                            chat_history_id,
-                            style_mode,
-                            processed_claims=processed_claims
-                        )
-
-                        api_response = "Processed all claims and generated analysis."
-                        if engage_workflow:
-                            next_steps_instruction = "Now perform imprecise language identification analysis."
-                        else:
-                            next_steps_instruction = "Proceed"
-                        response_part = Part.from_function_response(
-                            name=function_call_name,
-                            response={
-                                "content": api_response,
-                                "processed_claims": processed_claims,
-                                "next_steps_instruction": next_steps_instruction
-                            },
+                    elif function_call_name == 'medical_claims_identification':
+                        response_part, claims = _process_medical_claims(
+                            part, "Proceed", verification_prompt, text_generator, user_id, chat_history_id, style_mode,
+                            pending_updates
                         )
+                        processed_claims = claims or processed_claims
                         response_parts.append(response_part)
-                    except Exception as e:
-                        # Handle any errors that occurred during the request
-                        local_error_message = f"Error when Identifying Medical Claims: {str(e)}"
-                        error_message += f"\n{local_error_message}"
-                        response_part = Part.from_function_response(
+                    else:
+                        # Every function call needs a response, even one we do not handle
+                        response_parts.append(Part.from_function_response(
                             name=function_call_name,
-                            response={
-                                "error": local_error_message,
-                                "instructions": "Error occurred while identifying medical claims. Please try again."},
-                        )
-                        response_parts.append(response_part)
+                            response={"error": f"Unknown function: {function_call_name}"},
+                        ))
 
-            if break_loop:
-                break
-            else:
-                if loop_count == 0:
-                    chat = imprecise_language_model_instance.start_chat(history=chat.history)
-                    response = chat.send_message(response_parts)
-                    loop_count += 1
-                    pass
+                if break_loop:
+                    break
                 else:
-                    chat = output_response_model_instance.start_chat(history=chat.history, response_validation=False)
-                    response = chat.send_message(response_parts)
+                    if loop_count == 0:
+                        response = chat.send_message(response_parts)
+                        loop_count += 1
+                    else:
+                        chat = output_response_model_instance.start_chat(history=chat.history, response_validation=False)
+                        response = chat.send_message(response_parts)
+        history = chat.history
     except Exception as e:
+        print(f"Error occurred: {e}")
         output_text = f"Please try again. An unexpected error occurred."
+        # Keep the user's turn with the error reply, dropping any partial function calling
+        # turns, so the stored history stays valid for the next turn
+        history = chat_history[:stored_history_length] + [
+            _to_user_content(prompt),
+            Content(role="model", parts=[Part.from_text(output_text)])
+        ]
+
+    # Wait for partial Firestore updates so they land before the caller's final update
+    for pending_update in pending_updates:
+        try:
+            pending_update.result()
+        except Exception as e:
+            print(f"Error when updating Firestore: {e}")
 
-    # Save chat history
+    # Save chat history. A failure here must not fail the task, since a retry would rerun the
+    # whole workflow.
     if save_session_history:
-        save_chat_history(user_id, chat_history_id, chat.history)
+        try:
+            save_chat_history(user_id, chat_history_id, history, start_index=stored_history_length)
+        except Exception as e:
+            print(f"Error saving chat history {chat_history_id}: {e}")
 
     return output_text, chat_history_id, processed_claims, processed_imprecise_language_instances
+
+
+def _run_workflow(
+    prompt,
+    chat_history: List[Content],
+    function_calling_model_instance: GenerativeModel,
+    output_response_model_instance: GenerativeModel,
+    text_generator: TextGenerator,
+    verification_prompt: str,
+    user_id: Optional[str],
+    chat_history_id: str,
+    style_mode: str,
+    pending_updates: List[Future]
+):
+    """Run the claims and imprecise language identification calls concurrently."""
+    # Chat sessions do not take a per-call tool config, so query the shared model directly
+    contents = list(chat_history) + [_to_user_content(prompt)]
+
+    async def send_messages():
+        return await asyncio.gather(
+            function_calling_model_instance.generate_content_async(
+                contents, tool_config=MEDICAL_CLAIMS_TOOL_CONFIG
+            ),
+            function_calling_model_instance.generate_content_async(
+                contents, tool_config=IMPRECISE_LANGUAGE_TOOL_CONFIG
+            )
+        )
+
+    claims_response, imprecise_language_response = run_async(send_messages())
+    claims_calls = _get_function_calls(claims_response, "medical_claims_identification")
+    imprecise_language_calls = _get_function_calls(imprecise_language_response, "imprecise_language_identification")
+
+    next_steps_instruction = (
+        "Respond that the input text has been processed and summarize the findings. "
+        "Ask if the user needs help understanding the findings or would like to know more "
+        "about any finding in particular."
+    )
+    processed_claims = None
+    processed_imprecise_language_instances = None
+    response_parts = []
+    for part in claims_calls:
+        response_part, claims = _process_medical_claims(
+            part, next_steps_instruction, verification_prompt, text_generator, user_id, chat_history_id, style_mode,
+            pending_updates
+        )
+        if claims:
+            processed_claims = (processed_claims or []) + claims
+        response_parts.append(response_part)
+    for part in imprecise_language_calls:
+        response_part, instances = _process_imprecise_language(
+            part, next_steps_instruction, user_id, chat_history_id, style_mode, pending_updates
+        )
+        if instances:
+            processed_imprecise_language_instances = (processed_imprecise_language_instances or []) + instances
+        response_parts.append(response_part)
+
+    # Merge both sets of function calls into a single model turn answered by the output model.
+    # Only the calls are recorded, so each one lines up with exactly one function response.
+    history = contents + [
+        Content(role="model", parts=claims_calls + imprecise_language_calls)
+    ]
+    chat = output_response_model_instance.start_chat(history=history, response_validation=False)
+    response = chat.send_message(response_parts)
+    output_text = response.candidates[0].content.parts[0].text
+
+    return chat, output_text, processed_claims, processed_imprecise_language_instances
+
+
+def _get_function_calls(response, function_name: str) -> List[Part]:
+    """Get the function call parts of a response forced to call function_name, or raise ValueError."""
+    if not response.candidates:
+        raise ValueError(f"No candidates returned for {function_name}")
+    function_calls = [part for part in response.candidates[0].content.parts if part.function_call.name]
+    if not function_calls or any(part.function_call.name != function_name for part in function_calls):
+        raise ValueError(
+            f"Expected calls to {function_name}, got {[part.function_call.name for part in function_calls]}"
+        )
+    return function_calls
+
+
+def _process_imprecise_language(
+    part: Part,
+    next_steps_instruction: str,
+    user_id: Optional[str],
+    chat_history_id: str,
+    style_mode: str,
+    pending_updates: List[Future]
+):
+    """Handle an imprecise language identification function call."""
+    function_call_name = part.function_call.name
+    try:
+        # Handle imprecise language identification request
+        args = get_function_call_args(part)
+        processed_imprecise_language_instances = args.get('identified_instances', [])
+
+        if processed_imprecise_language_instances:
+            for processed_instance in processed_imprecise_language_instances:
+                processed_instance["id"] = str(uuid4())
+
+        # Partial update with imprecise language instances, written in the background
+        pending_updates.append(endpoint_utils.submit_firestore_update(
+            user_id,
+            chat_history_id,
+            style_mode,
+            processed_imprecise_language_instances=processed_imprecise_language_instances
+        ))
+
+        response_part = Part.from_function_response(
+            name=function_call_name,
+            response={
+                "content": "Processed all imprecise language identified.",
+                "processed_imprecise_language_instances": processed_imprecise_language_instances,
+                "next_steps_instruction": next_steps_instruction
+            },
+        )
+        return response_part, processed_imprecise_language_instances
+    except Exception as e:
+        # Handle any errors that occurred during the request
+        response_part = Part.from_function_response(
+            name=function_call_name,
+            response={
+                "error": f"Error when Identifying Imprecise Language: {str(e)}",
+                "instructions": "Error occurred while identifying imprecise language. Please try again."},
+        )
+        return response_part, None
+
+
+def _process_medical_claims(
+    part: Part,
+    next_steps_instruction: str,
+    verification_prompt: str,
+    text_generator: TextGenerator,
+    user_id: Optional[str],
+    chat_history_id: str,
+    style_mode: str,
+    pending_updates: List[Future]
+):
+    """Handle a medical claims identification function call."""
+    function_call_name = part.function_call.name
+    try:
+        # Handle medical claims identification request
+        args = get_function_call_args(part)
+        identified_claims_data = args.get('identified_claims', [])
+
+        claims = [identified_claim["claim"] for identified_claim in identified_claims_data]
+        prompts = [verification_prompt.format(input_claim=claim) for claim in claims]
+        structured_claims_results = text_generator.generate_texts(
+            prompts, post_process=lambda result: structure_claims_analysis(result.to_dict())
+        )
+        processed_claims = [{**claim_data, **structured_claims_result} for claim_data, structured_claims_result
+                            in zip(identified_claims_data, structured_claims_results)]
+
+        if processed_claims:
+            for processed_claim in processed_claims:
+                processed_claim["id"] = str(uuid4())
+
+        # Partial update with processed claims, written in the background
+        pending_updates.append(endpoint_utils.submit_firestore_update(
+            user_id,
+            chat_history_id,
+            style_mode,
+            processed_claims=processed_claims
+        ))
+
+        response_part = Part.from_function_response(
+            name=function_call_name,
+            response={
+                "content": "Processed all claims and generated analysis.",
+                "processed_claims": processed_claims,
+                "next_steps_instruction": next_steps_instruction
+            },
+        )
+        return response_part, processed_claims
+    except Exception as e:
+        # Handle any errors that occurred during the request
+        response_part = Part.from_function_response(
+            name=function_call_name,
+            response={
+                "error": f"Error when Identifying Medical Claims: {str(e)}",
+                "instructions": "Error occurred while identifying medical claims. Please try again."},
+        )
+        return response_part, None
@@ -1,15 +1,27 @@
 import os
 import traceback
-import vertexai
-import vertexai.preview.generative_models as generative_models
 from vertexai.generative_models import (
     GenerationConfig,
+    GenerationResponse,
     GenerativeModel,
 )
-from typing import Optional
+from typing import Iterable, Optional
 from uuid import uuid4
 
-from src.chat.utils import get_chat_history, save_chat_history
+from src.chat.utils import SAFETY_SETTINGS, get_chat_history, init_vertexai, save_chat_history
+
+
+def join_streamed_text(responses: Iterable[GenerationResponse]) -> str:
+    """Concatenate the text parts of streamed responses, skipping chunks without text."""
+    texts = []
+    for response in responses:
+        for candidate in response.candidates[:1]:
+            for part in candidate.content.parts:
+                try:
+                    texts.append(part.text)
+                except AttributeError:
+                    continue
+    return "".join(texts)
 
 
 def generate_text(
@@ -25,33 +37,27 @@ def generate_text(
     response_mime_type: Optional[str] = None
 ):
     """Generate text."""
-    vertexai.init(project=project_id, location=location)
+    init_vertexai(project_id, location)
+
+    # Both models share one generation config
+    generation_config = GenerationConfig(
+        temperature=0.2,
+        max_output_tokens=max_output_tokens,
+        response_mime_type=response_mime_type
+    )
 
     # Initialize Gemini model
     model = GenerativeModel(
         model_name,
         system_instruction=None if not system_instruction else [system_instruction],
-        generation_config=GenerationConfig(
-            temperature=0.2,
-            max_output_tokens=max_output_tokens,
-            response_mime_type=response_mime_type
-        ),
-        safety_settings={
-            generative_models.HarmCategory.HARM_CATEGORY_HATE_SPEECH: generative_models.HarmBlockThreshold.BLOCK_NONE,
-            generative_models.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: generative_models.HarmBlockThreshold.BLOCK_NONE,
-            generative_models.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: generative_models.HarmBlockThreshold.BLOCK_NONE,
-            generative_models.HarmCategory.HARM_CATEGORY_HARASSMENT: generative_models.HarmBlockThreshold.BLOCK_NONE,
-        },
+        generation_config=generation_config,
+        safety_settings=SAFETY_SETTINGS,
     )
 
     with_safety_settings_model = GenerativeModel(
         model_name,
         system_instruction=None if not system_instruction else [system_instruction],
-        generation_config=GenerationConfig(
-            temperature=0.2,
-            max_output_tokens=max_output_tokens,
-            response_mime_type=response_mime_type
-        )
+        generation_config=generation_config
     )
 
     if chat_history_id:
@@ -60,23 +66,23 @@ def generate_text(
     else:
         chat_history_id, chat_history = str(uuid4()), []
         chat = model.start_chat()
+    # Chat sessions extend the history list in place, so remember what is already stored
+    stored_history_length = len(chat_history)
 
     try:
-        response = chat.send_message(prompt)
-
-        output_text = response.text
+        # Stream the response so generation is consumed as it is produced
+        output_text = join_streamed_text(chat.send_message(prompt, stream=True))
     except Exception as e:
         try:
             with_ss_chat = with_safety_settings_model.start_chat(history=chat_history)
-            response = with_ss_chat.send_message(prompt)
-            output_text = response.text
+            output_text = join_streamed_text(with_ss_chat.send_message(prompt, stream=True))
         except:
             print(f"Error occurred: {e}\n{traceback.format_exc()}")
             output_text = f"Please try again. An unexpected error occurred: {e}\n{traceback.format_exc()}"
 
     # Save session history
     if save_session_history:
-        save_chat_history(user_id, chat_history_id, chat.history)
+        save_chat_history(user_id, chat_history_id, chat.history, start_index=stored_history_length)
     else:
         chat_history_id = None
 
@@ -1,11 +1,54 @@
-import concurrent.futures
-import threading
-import time
-from tqdm import tqdm
-from typing import Any, List, Optional
+import asyncio
+import hashlib
+import weakref
+from cachetools import TTLCache
+from collections import deque
+from tqdm.asyncio import tqdm_asyncio
+from typing import Any, Callable, Dict, List, Optional
+from vertexai.generative_models import FinishReason
 
-import vertexai
-import vertexai.preview.generative_models as generative_models
+from src.chat.utils import SAFETY_SETTINGS, clean_text, init_vertexai, run_async
+
+# Cache configuration for generated responses
+RESPONSE_CACHE_SIZE = 1024
+RESPONSE_CACHE_TTL = 24 * 3600  # Cache duration in seconds (24 hours)
+
+
+class RateLimiter:
+    """Sliding window rate limiter allowing at most max_calls in any period of seconds."""
+
+    def __init__(self, max_calls: int, period: float = 60):
+        self.max_calls = max_calls
+        self.period = period
+        self.call_times = deque()
+
+    async def acquire(self):
+        """Wait only as long as needed for the oldest call to leave the window."""
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            while self.call_times and now - self.call_times[0] >= self.period:
+                self.call_times.popleft()
+            if len(self.call_times) < self.max_calls:
+                self.call_times.append(now)
+                return
+            await asyncio.sleep(self.period - (now - self.call_times[0]))
+
+
+# Rate limiters shared by every TextGenerator on the event loop, keyed by calls per minute
+_rate_limiters: Dict[int, RateLimiter] = {}
+
+# Response caches per model instance. Only touched from coroutines on the shared event
+# loop, so no locking is needed.
+_response_caches = weakref.WeakKeyDictionary()
+
+
+def _is_cacheable_response(response) -> bool:
+    """Check that a response completed normally and is grounded, so a degraded one is never reused."""
+    if not response.candidates:
+        return False
+    candidate = response.candidates[0]
+    return candidate.finish_reason == FinishReason.STOP and bool(candidate.grounding_metadata.grounding_supports)
 
 
 class TextGenerator:
@@ -30,17 +73,14 @@ class TextGenerator:
         self.max_output_tokens = max_output_tokens
         self.verbose = verbose
         self.max_calls_per_minute = max_calls_per_minute
-        self.call_count = 0
-        self.lock = threading.Lock()
+        self.rate_limiter = _rate_limiters.setdefault(max_calls_per_minute, RateLimiter(max_calls_per_minute))
+        init_vertexai(project_id, location)
 
     def generate_text(
         self,
         contents,
     ) -> str:
         """Generate text."""
-
-        vertexai.init(project=self.project_id, location=self.location)
-
         # Query the model
         response = self.model_instance.generate_content(
             contents=contents,
@@ -48,12 +88,8 @@ class TextGenerator:
                 "temperature": self.temperature,
                 "max_output_tokens": self.max_output_tokens,
             },
-            safety_settings={
-              generative_models.HarmCategory.HARM_CATEGORY_HATE_SPEECH: generative_models.HarmBlockThreshold.BLOCK_NONE,
-              generative_models.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: generative_models.HarmBlockThreshold.BLOCK_NONE,
-              generative_models.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: generative_models.HarmBlockThreshold.BLOCK_NONE,
-              generative_models.HarmCategory.HARM_CATEGORY_HARASSMENT: generative_models.HarmBlockThreshold.BLOCK_NONE,
-            }, stream=False
+            safety_settings=SAFETY_SETTINGS,
+            stream=False
         )
 
         if self.verbose:
@@ -61,25 +97,73 @@ class TextGenerator:
 
         return response
 
-    def process_text(self, contents):
+    def _get_response_cache(self) -> TTLCache:
+        """Get the response cache for this generator's model."""
+        response_cache = _response_caches.get(self.model_instance)
+        if response_cache is None:
+            response_cache = TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+            _response_caches[self.model_instance] = response_cache
+        return response_cache
+
+    def _get_response_cache_key(self, contents) -> Optional[str]:
+        """Hash the normalized prompt and generation parameters, or None if not cacheable."""
+        if not isinstance(contents, str):
+            return None
+        key = f"{self.temperature}\0{self.max_output_tokens}\0{clean_text(contents).strip()}"
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    async def _agenerate_text(self, contents):
+        """Generate text asynchronously."""
+        # Query the model without blocking the event loop
+        response = await self.model_instance.generate_content_async(
+            contents=contents,
+            generation_config={
+                "temperature": self.temperature,
+                "max_output_tokens": self.max_output_tokens,
+            },
+            safety_settings=SAFETY_SETTINGS,
+            stream=False
+        )
+
+        if self.verbose:
+            print(response.text)
+
+        return response
+
+    async def _aprocess_text(self, contents):
         """Process text."""
-        with self.lock:
-            if self.call_count >= self.max_calls_per_minute:
-                time.sleep(60)
-                self.call_count = 0
-            self.call_count += 1
-        return self.generate_text(contents)
-
-    def generate_texts(self, contents_list: List[str], num_threads: int = 5):
-        """Generate texts."""
-        results = [None] * len(contents_list)
-        with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
-            future_to_content = {executor.submit(self.process_text, content): (index, content) for index, content in enumerate(contents_list)}
-            for future in tqdm(concurrent.futures.as_completed(future_to_content), total=len(future_to_content), desc="Processing texts"):
-                index, content = future_to_content[future]
-                try:
-                    result = future.result()
-                    results[index] = result
-                except Exception as e:
-                    print(f"Generated an exception for {content}: {e}")
-        return results
+        # Identical prompts recur across users, so serve them from the cache when possible
+        response_cache = self._get_response_cache()
+        cache_key = self._get_response_cache_key(contents)
+        if cache_key is not None:
+            response = response_cache.get(cache_key)
+            if response is not None:
+                return response
+
+        await self.rate_limiter.acquire()
+        response = await self._agenerate_text(contents)
+
+        if cache_key is not None and _is_cacheable_response(response):
+            response_cache[cache_key] = response
+        return response
+
+    async def _agenerate_texts(self, contents_list: List[str], post_process: Optional[Callable[[Any], Any]] = None):
+        """Generate texts concurrently on the event loop."""
+        async def process(content):
+            try:
+                response = await self._aprocess_text(content)
+                # Post-process each response as it arrives, overlapping the remaining calls
+                return post_process(response) if post_process else response
+            except Exception as e:
+                print(f"Generated an exception for {content}: {e}")
+                return None
+
+        return await tqdm_asyncio.gather(
+            *[process(content) for content in contents_list],
+            total=len(contents_list),
+            desc="Processing texts"
+        )
+
+    def generate_texts(self, contents_list: List[str], post_process: Optional[Callable[[Any], Any]] = None):
+        """Generate texts, optionally applying post_process to each response."""
+        return run_async(self._agenerate_texts(contents_list, post_process))
@@ -1,21 +1,95 @@
-import json
+import asyncio
 import jsonpickle
 import mimetypes
+import orjson
 import os
 import re
-from google.cloud import storage
-from typing import Any, Optional
+import tempfile
+import threading
+import vertexai
+from cachetools.func import ttl_cache
+from concurrent.futures import ThreadPoolExecutor
+from google.api_core.exceptions import Conflict
+from google.cloud.storage import transfer_manager
+from typing import List, Optional, Set
 from uuid import uuid4
-from vertexai.generative_models import FunctionDeclaration
+from vertexai.generative_models import Content, FunctionDeclaration, HarmBlockThreshold, HarmCategory, Tool
 
 import src.remote_config.utils as remote_config_utils
+from src.clients.google_cloud import (
+    FIRESTORE_BATCH_LIMIT,
+    FIRESTORE_BATCH_SIZE_LIMIT,
+    get_bucket,
+    get_firestore_client
+)
+
+_WHITESPACE_RE = re.compile(r'\s+')
+
+# Safety settings shared by every Gemini model in the chat package
+SAFETY_SETTINGS = {
+    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
+}
+
+# Prompts and function declarations rarely change; keep them warm for a few minutes
+PROMPT_CACHE_TTL = 300  # Cache duration in seconds (5 minutes)
+
+# Chat histories are stored as {"version": ..., "contents": [...]}; legacy jsonpickle
+# histories are JSON arrays, so the first byte tells the two formats apart
+CHAT_HISTORY_FORMAT_VERSION = 2
+
+# Firestore documents are limited to 1 MiB; history entries larger than this (for example
+# function responses carrying many processed claims) are stored in GCS and referenced
+MAX_HISTORY_ENTRY_SIZE = 900 * 1024  # 900 KiB
+
+# Images larger than this are uploaded as concurrent multipart chunks
+PARALLEL_UPLOAD_THRESHOLD = 8 * 1024 * 1024  # 8 MiB
+PARALLEL_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # 8 MiB
+
+# Shared event loop for async Vertex AI calls. The SDK's async clients are bound to the
+# loop they were created on, so every coroutine is run on this one long-lived loop.
+_event_loop = None
+_event_loop_lock = threading.Lock()
+
+# Project and location Vertex AI was last initialized with
+_vertexai_config = None
+
+# Executor for archiving chat histories to Cloud Storage off the request path
+_archive_executor = ThreadPoolExecutor(max_workers=2)
+
+
+def run_async(coroutine):
+    """Run a coroutine on the shared background event loop and wait for its result."""
+    global _event_loop
+    with _event_loop_lock:
+        if _event_loop is None:
+            _event_loop = asyncio.new_event_loop()
+            threading.Thread(target=_event_loop.run_forever, daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coroutine, _event_loop).result()
+
+
+def init_vertexai(project_id: Optional[str], location: str):
+    """Initialize Vertex AI once per process for the given project and location."""
+    global _vertexai_config
+    if _vertexai_config != (project_id, location):
+        vertexai.init(project=project_id, location=location)
+        _vertexai_config = (project_id, location)
 
 
 def clean_text(text: str):
     """Clean text."""
-    return re.sub(r'\s+', ' ', text)
+    if text.isascii():
+        # str.split() collapses the same whitespace runs as the regex, in C
+        words = text.split()
+        leading = ' ' if text[:1].isspace() else ''
+        trailing = ' ' if words and text[-1:].isspace() else ''
+        return leading + ' '.join(words) + trailing
+    return _WHITESPACE_RE.sub(' ', text)
 
 
+@ttl_cache(maxsize=64, ttl=PROMPT_CACHE_TTL)
 def get_config_and_prompt(config_key: str):
     """Helper function to get configuration and prompt."""
     config = remote_config_utils.get_remote_config_value("Prompts", config_key)
@@ -27,10 +101,11 @@ def get_config_and_prompt(config_key: str):
     return prompt
 
 
+@ttl_cache(maxsize=64, ttl=PROMPT_CACHE_TTL)
 def create_function_declaration(name: str, description_key: str, parameters_key: str):
     """Helper function to create a FunctionDeclaration."""
     description = get_config_and_prompt(description_key)
-    parameters = json.loads(get_config_and_prompt(parameters_key))
+    parameters = orjson.loads(get_config_and_prompt(parameters_key))
     return FunctionDeclaration(
         name=name,
         description=description,
@@ -38,41 +113,201 @@ def create_function_declaration(name: str, description_key: str, parameters_key:
     )
 
 
-def get_chat_history(user_id: str, chat_history_id: Optional[str] = None):
-    """Fetch chat history from Google Cloud Storage."""
-    if not chat_history_id:
-        return []
+@ttl_cache(maxsize=1, ttl=PROMPT_CACHE_TTL)
+def get_citations_tool():
+    """Get the Tool declaring the medical claims and imprecise language functions."""
+    # Identify imprecise language
+    identify_imprecise_language_function = create_function_declaration(
+        "imprecise_language_identification",
+        "identify_imprecise_language_multi_function_description",
+        "identify_imprecise_language_multi_function_parameters"
+    )
+
+    # Identify medical claims
+    identify_medical_claims_function = create_function_declaration(
+        "medical_claims_identification",
+        "identify_medical_claims_multi_function_description",
+        "identify_medical_claims_multi_function_parameters"
+    )
+
+    return Tool(
+        function_declarations=[
+            identify_imprecise_language_function,
+            identify_medical_claims_function,
+        ],
+    )
+
+
+def encode_chat_history(chat_history: List[Content]) -> bytes:
+    """Encode chat history as versioned JSON."""
+    return orjson.dumps({
+        "version": CHAT_HISTORY_FORMAT_VERSION,
+        "contents": [content.to_dict() for content in chat_history]
+    })
+
+
+def decode_chat_history(encoded_chat_history: bytes) -> List[Content]:
+    """Decode chat history, falling back to jsonpickle for legacy histories."""
+    if encoded_chat_history[:1] == b"{":
+        data = orjson.loads(encoded_chat_history)
+        return [Content.from_dict(content) for content in data["contents"]]
+    return jsonpickle.decode(encoded_chat_history.decode("utf-8"))
 
-    client = storage.Client()
-    bucket = client.bucket(os.getenv("GOOGLE_CLOUD_BUCKET"))
+
+def _get_history_collection(user_id: str, chat_history_id: str):
+    """Get the Firestore collection holding one document per chat history entry."""
+    return (get_firestore_client().collection('users').document(user_id)
+            .collection('chats').document(chat_history_id).collection('history'))
+
+
+def _write_chat_history_entries(user_id: str, chat_history_id: str, chat_history: List[Content], start_index: int,
+                                skip_indexes: Optional[Set[int]] = None, migrated_length: Optional[int] = None):
+    """
+    Create chat history entries from start_index onwards in Firestore.
+
+    Entries are created rather than overwritten, so if another request already stored
+    entries at the same positions the batch fails with Conflict instead of mixing turns.
+    A turn's entries fit in one batch, so each turn is stored entirely or not at all.
+    Migrations pass migrated_length, which is stored on every entry so that reads can
+    tell a partially migrated history from a complete one.
+    """
+    db = get_firestore_client()
+    history_ref = _get_history_collection(user_id, chat_history_id)
+    indexes = [index for index in range(start_index, len(chat_history)) if index not in (skip_indexes or ())]
+
+    batch = db.batch()
+    batch_count = 0
+    batch_size = 0
+    spilled_blobs = []
+    for position, index in enumerate(indexes):
+        content = orjson.dumps(chat_history[index].to_dict())
+        if len(content) > MAX_HISTORY_ENTRY_SIZE:
+            # Too large for a Firestore document; store it under a unique name in GCS
+            bucket = get_bucket(os.getenv("GOOGLE_CLOUD_BUCKET"))
+            blob = bucket.blob(f"users/{user_id}/chats/{chat_history_id}/history/{index:06d}-{uuid4()}.json")
+            blob.upload_from_string(content, content_type='application/json')
+            spilled_blobs.append(blob)
+            entry = {'index': index, 'content_blob': blob.name}
+            entry_size = len(blob.name)
+        else:
+            entry = {'index': index, 'content': content.decode('utf-8')}
+            entry_size = len(content)
+        if migrated_length is not None:
+            entry['migrated_length'] = migrated_length
+        batch.create(history_ref.document(f"{index:06d}"), entry)
+        batch_count += 1
+        batch_size += entry_size
+
+        # Commit before the next entry could push the batch past either Firestore limit
+        is_last = position == len(indexes) - 1
+        if (is_last or batch_count == FIRESTORE_BATCH_LIMIT
+                or batch_size + MAX_HISTORY_ENTRY_SIZE > FIRESTORE_BATCH_SIZE_LIMIT):
+            try:
+                batch.commit()
+            except Exception:
+                # Nothing in the batch was stored, so its blobs are unreferenced
+                for blob in spilled_blobs:
+                    blob.delete()
+                raise
+            batch = db.batch()
+            batch_count = 0
+            batch_size = 0
+            spilled_blobs = []
+
+
+def _is_complete_chat_history(entries: List[dict]) -> bool:
+    """Check that stored entries form the whole history: indexes 0..n-1 and nothing left to migrate."""
+    if not entries:
+        return False
+    if any(entry['index'] != index for index, entry in enumerate(entries)):
+        return False
+    return len(entries) >= entries[0].get('migrated_length', 0)
+
+
+def _decode_chat_history_entry(entry: dict) -> Content:
+    """Decode a chat history entry document, fetching its content from GCS if it was spilled there."""
+    if 'content_blob' in entry:
+        bucket = get_bucket(os.getenv("GOOGLE_CLOUD_BUCKET"))
+        content = bucket.blob(entry['content_blob']).download_as_bytes()
+    else:
+        content = entry['content']
+    return Content.from_dict(orjson.loads(content))
+
+
+def _get_archived_chat_history(user_id: str, chat_history_id: str):
+    """Fetch the archived chat history from Google Cloud Storage."""
+    bucket = get_bucket(os.getenv("GOOGLE_CLOUD_BUCKET"))
     blob = bucket.blob(f"users/{user_id}/chats/{chat_history_id}.txt")
 
     if blob.exists():
-        return jsonpickle.decode(blob.download_as_text())
+        return decode_chat_history(blob.download_as_bytes())
     else:
         return []
 
 
-def save_chat_history(user_id: str, chat_history_id: str, chat_history: Any):
-    """Save updated chat history back to Google Cloud Storage."""
-    client = storage.Client()
-    bucket = client.bucket(os.getenv("GOOGLE_CLOUD_BUCKET"))
-    blob = bucket.blob(f"users/{user_id}/chats/{chat_history_id}.txt")
+def _archive_chat_history(user_id: str, chat_history_id: str, chat_history: List[Content]):
+    """Archive the full chat history to Google Cloud Storage."""
+    try:
+        bucket = get_bucket(os.getenv("GOOGLE_CLOUD_BUCKET"))
+        blob = bucket.blob(f"users/{user_id}/chats/{chat_history_id}.txt")
+        blob.upload_from_string(encode_chat_history(chat_history), content_type='application/json')
+    except Exception as e:
+        print(f"Error archiving chat history {chat_history_id}: {e}")
 
-    if isinstance(chat_history, list):
-        encoded_chat_history = jsonpickle.encode(chat_history, True)
-    else:
-        encoded_chat_history = chat_history
 
-    # Convert the chat history to JSON and upload
-    blob.upload_from_string(encoded_chat_history, content_type='text/plain')
+def get_chat_history(user_id: str, chat_history_id: Optional[str] = None):
+    """Fetch chat history from Firestore, migrating histories only archived in GCS."""
+    if not chat_history_id:
+        return []
+
+    documents = _get_history_collection(user_id, chat_history_id).order_by('index').stream()
+    entries = [document.to_dict() for document in documents]
+    if _is_complete_chat_history(entries):
+        return [_decode_chat_history_entry(entry) for entry in entries]
+
+    # Histories saved before the move to Firestore only exist in GCS, and an interrupted
+    # migration leaves only part of them in Firestore; the archive holds the full history
+    chat_history = _get_archived_chat_history(user_id, chat_history_id)
+    if chat_history:
+        # The migration is best effort; the archived history has already been read
+        try:
+            _write_chat_history_entries(
+                user_id,
+                chat_history_id,
+                chat_history,
+                0,
+                skip_indexes={entry['index'] for entry in entries},
+                migrated_length=len(chat_history)
+            )
+        except Conflict:
+            # Another request is migrating the same archived history
+            pass
+        except Exception as e:
+            print(f"Error migrating chat history {chat_history_id}: {e}")
+    return chat_history
+
+
+def save_chat_history(user_id: str, chat_history_id: str, chat_history: List[Content], start_index: int = 0):
+    """
+    Append new chat history entries to Firestore and archive the full history to GCS.
+
+    Entries before start_index are assumed to be stored already, so only the messages
+    added during this turn are written. The GCS archive is written in the background.
+    If another request stored a turn at the same positions first, this turn is dropped
+    so the stored history never mixes entries from two turns.
+    """
+    try:
+        _write_chat_history_entries(user_id, chat_history_id, chat_history, start_index)
+    except Conflict:
+        print(f"Chat history {chat_history_id} was updated concurrently; not saving this turn")
+        return
+    _archive_executor.submit(_archive_chat_history, user_id, chat_history_id, list(chat_history))
 
 
 def upload_image_to_gcs(user_id: str, chat_history_id: str, image_bytes: bytes, image_mime_type: str):
     """Uploads image bytes to GCS bucket with a random UUID as the file name."""
-    storage_client = storage.Client()
     bucket_name = os.getenv("GOOGLE_CLOUD_BUCKET")
-    bucket = storage_client.bucket(bucket_name)
+    bucket = get_bucket(bucket_name)
 
     # Get the file extension from the MIME type
     extension = mimetypes.guess_extension(image_mime_type)
@@ -82,5 +317,18 @@ def upload_image_to_gcs(user_id: str, chat_history_id: str, image_bytes: bytes,
     # Generate a unique name with the correct extension
     image_name = f"users/{user_id}/chats/{chat_history_id}/{uuid4()}{extension}"
     blob = bucket.blob(image_name)
-    blob.upload_from_string(image_bytes, content_type=image_mime_type)
+    if len(image_bytes) > PARALLEL_UPLOAD_THRESHOLD:
+        # The transfer manager only uploads from files, so stage the bytes on disk first
+        with tempfile.NamedTemporaryFile(suffix=extension) as image_file:
+            image_file.write(image_bytes)
+            image_file.flush()
+            transfer_manager.upload_chunks_concurrently(
+                image_file.name,
+                blob,
+                content_type=image_mime_type,
+                chunk_size=PARALLEL_UPLOAD_CHUNK_SIZE,
+                worker_type=transfer_manager.THREAD
+            )
+    else:
+        blob.upload_from_string(image_bytes, content_type=image_mime_type)
     return f"gs://{bucket_name}/{image_name}"
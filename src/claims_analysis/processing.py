@@ -1,6 +1,13 @@
 import re
+from operator import itemgetter
 from typing import Any, Dict
 
+_NUMBERED_SPLIT_RE = re.compile(r'\n\d+\.')
+_CITATION_RE = re.compile(r'\d+\.\s+\[(.*?)\]\((.*?)\)')
+
+# Precomputed string forms of citation numbers, which are almost always small
+_INT_STR = [str(i) for i in range(256)]
+
 
 def structure_claims_analysis(data: Dict[str, Any]) -> Dict[str, Any]:
     """Process API output."""
@@ -11,52 +18,52 @@ def structure_claims_analysis(data: Dict[str, Any]) -> Dict[str, Any]:
     grounding_supports = data['candidates'][0]['grounding_metadata']['grounding_supports']
     grounding_chunks = data['candidates'][0]['grounding_metadata']['grounding_chunks']
 
-    # Sort grounding supports by start index
-    grounding_supports.sort(key=lambda x: x['segment'].get('start_index', 0))
+    # Sort grounding supports by start index, reading each start index only once
+    sorted_supports = sorted(
+        ((support['segment'].get('start_index', 0), support) for support in grounding_supports),
+        key=itemgetter(0)
+    )
 
     # Process text and add citations with confidence scores
-    processed_text = ""
+    processed_parts = []
     last_end = 0
-    for support in grounding_supports:
-        start = support['segment'].get('start_index', 0)
+    for start, support in sorted_supports:
         end = support['segment']['end_index']
         citation_indices = [index + 1 for index in support['grounding_chunk_indices']]  # Add 1 to each index
         confidence_score = support['confidence_scores'][0]  # All scores are the same, so we take the first one
+        citation_numbers = ','.join(_INT_STR[i] if i < 256 else str(i) for i in citation_indices)
 
-        processed_text += text[last_end:start]
-        processed_text += text[start:end]
-        processed_text += f"[{','.join(map(str, citation_indices))}][{confidence_score:.2f}]"
+        # One slice covers the gap and the segment; overlapping segments repeat from their start
+        processed_parts.append(text[min(last_end, start):end])
+        processed_parts.append('[%s][%.2f]' % (citation_numbers, confidence_score))
 
         last_end = end
 
-    processed_text += text[last_end:]
-
-    # Generate citations list
-    citations = []
-    for i, chunk in enumerate(grounding_chunks, start=1):  # Start enumeration from 1
-        title = chunk['web']['title']
-        uri = chunk['web']['uri']
-        citations.append(f"{i}. [{title}]({uri})")
+    processed_parts.append(text[last_end:])
+    processed_text = "".join(processed_parts)
 
-    output_markdown = generate_markdown(processed_text, citations)
+    output_markdown = generate_markdown(processed_text, grounding_chunks)
     structured_claims_analysis = parse_claim_analysis(output_markdown)
     return structured_claims_analysis
 
 
-def generate_markdown(processed_text, citations):
-    markdown = processed_text + "\n\n## Citations\n\n" + "\n".join(citations)
-    return markdown
+def generate_markdown(processed_text, grounding_chunks):
+    # Number citations from 1, formatting them straight into the join
+    citations = "\n".join(
+        f"{i}. [{chunk['web']['title']}]({chunk['web']['uri']})" for i, chunk in enumerate(grounding_chunks, start=1)
+    )
+    return f"{processed_text}\n\n## Citations\n\n{citations}"
 
 
 def parse_claim_analysis(text: str) -> Dict[str, Any]:
     # Split the text into claim analysis and alternatives
-    parts = re.split(r'\nAlternatives:', text, maxsplit=1)
-    claim_analysis = parts[0].replace('Claim Analysis:', '').strip()
-    alternatives_text = parts[1] if len(parts) > 1 else ''
+    # The section markers are literals, so partition finds them without a regex pass
+    claim_analysis, _, alternatives_text = text.partition('\nAlternatives:')
+    claim_analysis = claim_analysis.replace('Claim Analysis:', '').strip()
 
     # Parse alternatives
     alternatives = []
-    for alt in re.split(r'\n\d+\.', alternatives_text):
+    for alt in _NUMBERED_SPLIT_RE.split(alternatives_text):
         if alt.strip():
             alt_parts = alt.split('Explanation:', 1)
             if len(alt_parts) == 2:
@@ -67,15 +74,14 @@ def parse_claim_analysis(text: str) -> Dict[str, Any]:
 
     # Extract citations
     citations = []
-    citation_pattern = r'\d+\.\s+\[(.*?)\]\((.*?)\)'
-    for match in re.finditer(citation_pattern, text):
+    for match in _CITATION_RE.finditer(text):
         citations.append({
             "title": match.group(1),
             "uri": match.group(2)
         })
 
     # Remove citations section from claim analysis
-    claim_analysis = re.sub(r'## Citations.*', '', claim_analysis, flags=re.DOTALL).strip()
+    claim_analysis = claim_analysis.partition('## Citations')[0].strip()
 
     # Structure the output
     structured_output = {
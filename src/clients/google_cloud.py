@@ -0,0 +1,81 @@
+import threading
+from google.cloud import firestore, storage
+from google.cloud import tasks_v2
+
+# Firestore allows at most 500 writes in a single batch
+FIRESTORE_BATCH_LIMIT = 500
+
+# Firestore rejects commits over 10 MiB; leave headroom for document names and metadata
+FIRESTORE_BATCH_SIZE_LIMIT = 9 * 1024 * 1024  # 9 MiB
+
+# Clients shared across requests so connections and credentials are reused. Each
+# constructor runs credential discovery and opens a new channel, so build them once.
+_storage_client = None
+_firestore_client = None
+_tasks_client = None
+_buckets = {}
+_clients_lock = threading.Lock()
+
+
+def get_storage_client() -> storage.Client:
+    """
+    Get the shared Cloud Storage client, creating it on first use.
+
+    Returns:
+        storage.Client: The process-wide Cloud Storage client
+    """
+    global _storage_client
+    if _storage_client is None:
+        with _clients_lock:
+            if _storage_client is None:
+                _storage_client = storage.Client()
+    return _storage_client
+
+
+def get_firestore_client() -> firestore.Client:
+    """
+    Get the shared Firestore client, creating it on first use.
+
+    Returns:
+        firestore.Client: The process-wide Firestore client
+    """
+    global _firestore_client
+    if _firestore_client is None:
+        with _clients_lock:
+            if _firestore_client is None:
+                _firestore_client = firestore.Client()
+    return _firestore_client
+
+
+def get_tasks_client() -> tasks_v2.CloudTasksClient:
+    """
+    Get the shared Cloud Tasks client, creating it on first use.
+
+    Returns:
+        tasks_v2.CloudTasksClient: The process-wide Cloud Tasks client
+    """
+    global _tasks_client
+    if _tasks_client is None:
+        with _clients_lock:
+            if _tasks_client is None:
+                _tasks_client = tasks_v2.CloudTasksClient()
+    return _tasks_client
+
+
+def get_bucket(bucket_name: str) -> storage.Bucket:
+    """
+    Get a Cloud Storage bucket handle, reusing handles by bucket name.
+
+    Args:
+        bucket_name (str): Name of the bucket
+
+    Returns:
+        storage.Bucket: Bucket bound to the shared Cloud Storage client
+
+    Note:
+        Bucket handles are local objects; no request is made to Cloud Storage
+    """
+    bucket = _buckets.get(bucket_name)
+    if bucket is None:
+        bucket = _buckets.setdefault(bucket_name, get_storage_client().bucket(bucket_name))
+    return bucket
@@ -1,7 +1,10 @@
-import time
-import json
+import orjson
 import os
-from google.cloud import storage
+import threading
+import time
+from cachetools import TTLCache
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed
+from datetime import timezone
 from functools import wraps
 from flask import request, Response
 from typing import Optional
@@ -9,6 +12,10 @@ from typing import Optional
 import google.auth
 import google.auth.transport.requests
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from src.clients.google_cloud import get_bucket
 
 # Configuration constants for Firebase Remote Config
 PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT")
@@ -16,13 +23,59 @@ BASE_URL = 'https://firebaseremoteconfig.googleapis.com'
 REMOTE_CONFIG_ENDPOINT = f'v1/projects/{PROJECT_ID}/remoteConfig'
 REMOTE_CONFIG_URL = f'{BASE_URL}/{REMOTE_CONFIG_ENDPOINT}'
 
-# Cache configuration
-remote_config_cache = {}  # Stores Remote Config parameter values
-remote_config_last_fetch = 0  # Timestamp of last Remote Config fetch
+# Session reusing HTTPS connections to Remote Config across fetches. Transient errors are
+# retried; the final response is returned rather than raised so callers can log it.
+_rc_session = requests.Session()
+_rc_session.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(
+        total=2,
+        backoff_factor=0.2,
+        status_forcelist=[429, 500, 502, 503, 504],
+        raise_on_status=False
+    )
+))
+
+# Credentials for Remote Config, discovered once. Their token is refreshed shortly
+# before it expires rather than on every fetch.
+ACCESS_TOKEN_REFRESH_MARGIN = 300  # Refresh this many seconds before the token expires
+ACCESS_TOKEN_DEFAULT_LIFETIME = 3300  # Assumed lifetime when credentials report no expiry
+_credentials = None
+_token_expiry = 0.0
+_access_token_lock = threading.Lock()
+
+# Hedged requests: when enabled, a backup fetch is sent if the first one has not
+# returned within REMOTE_CONFIG_HEDGE_DELAY seconds, and the faster response wins
+REMOTE_CONFIG_HEDGED_REQUESTS = os.getenv("REMOTE_CONFIG_HEDGED_REQUESTS", "false").lower() == "true"
+REMOTE_CONFIG_HEDGE_DELAY = 0.3  # Delay in seconds before sending the backup request
+_hedge_executor = ThreadPoolExecutor(max_workers=4)
+
+# Cache configuration. Remote Config values are refreshed ahead of expiry by a background
+# thread, which swaps in a freshly built dict so readers never see a partial template.
 REMOTE_CONFIG_CACHE_DURATION = 3600  # Cache duration in seconds (1 hour)
+REMOTE_CONFIG_REFRESH_MARGIN = 120  # Refresh this many seconds before the cache would expire
+REMOTE_CONFIG_RETRY_INTERVAL = 30  # Seconds to wait before retrying a failed refresh
+remote_config_cache = {}  # Stores Remote Config parameter values
+_rc_ready = threading.Event()  # Set once the first template has been loaded
 
 # Cache for GCS prompts to avoid repeated storage access
-gcs_prompt_cache = {}
+GCS_PROMPT_CACHE_DURATION = 3600  # Cache duration in seconds (1 hour)
+GCS_PROMPT_CACHE_SIZE = 256  # Maximum number of cached prompts
+gcs_prompt_cache = TTLCache(maxsize=GCS_PROMPT_CACHE_SIZE, ttl=GCS_PROMPT_CACHE_DURATION)
+
+# TTLCache is not thread-safe and Flask serves requests concurrently
+_cache_lock = threading.RLock()
+
+# Sentinel distinguishing a cache miss from a cached value
+_MISSING = object()
+
+# Prompt downloads in flight, so concurrent misses for the same file download it once
+_prompt_downloads = {}
+_prompt_downloads_lock = threading.Lock()
+
+# Serializes template fetches so the refresher and cold-start requests never fetch twice
+_rc_refresh_lock = threading.RLock()
 
 
 def get_access_token():
@@ -36,16 +89,69 @@ def get_access_token():
         str: The access token for authentication
 
     Note:
-        Requires the GOOGLE_CLOUD_PROJECT environment variable to be set
+        - Requires the GOOGLE_CLOUD_PROJECT environment variable to be set
+        - Credentials are discovered once and reused across calls
+        - The token is refreshed ACCESS_TOKEN_REFRESH_MARGIN seconds before it expires
     """
-    credentials, project_id = google.auth.default(
-        scopes=['https://www.googleapis.com/auth/firebase.remoteconfig']
-    )
-    # Set the quota project to ensure proper billing
-    credentials = credentials.with_quota_project(project_id)
-    auth_req = google.auth.transport.requests.Request()
-    credentials.refresh(auth_req)
-    return credentials.token
+    global _credentials, _token_expiry
+    with _access_token_lock:
+        now = time.time()
+        if _credentials is None:
+            credentials, project_id = google.auth.default(
+                scopes=['https://www.googleapis.com/auth/firebase.remoteconfig']
+            )
+            # Set the quota project to ensure proper billing
+            _credentials = credentials.with_quota_project(project_id)
+
+        if not _credentials.token or now > _token_expiry - ACCESS_TOKEN_REFRESH_MARGIN:
+            auth_req = google.auth.transport.requests.Request()
+            _credentials.refresh(auth_req)
+            if _credentials.expiry:
+                # google-auth reports expiry as a naive UTC datetime
+                _token_expiry = _credentials.expiry.replace(tzinfo=timezone.utc).timestamp()
+            else:
+                _token_expiry = now + ACCESS_TOKEN_DEFAULT_LIFETIME
+        return _credentials.token
+
+
+def hedged_get(url, headers, delay):
+    """
+    Send a GET request, racing a backup request if the first one is slow.
+
+    Args:
+        url (str): The URL to request
+        headers (dict): Headers to send with both requests
+        delay (float): Seconds to wait for the first response before sending the backup
+
+    Returns:
+        requests.Response: The first successful response
+
+    Raises:
+        requests.RequestException: When both requests fail
+
+    Note:
+        - Both requests share the pooled Remote Config session
+        - The slower request is left to finish in the background and its result is discarded
+    """
+    primary = _hedge_executor.submit(_rc_session.get, url, headers=headers)
+    error = None
+    try:
+        return primary.result(timeout=delay)
+    except FutureTimeoutError:
+        # Still in flight; race it against the backup
+        pending = [primary]
+    except requests.RequestException as e:
+        # Failed early; the backup is the only remaining attempt
+        error = e
+        pending = []
+
+    backup = _hedge_executor.submit(_rc_session.get, url, headers=headers)
+    for future in as_completed(pending + [backup]):
+        try:
+            return future.result()
+        except requests.RequestException as e:
+            error = e
+    raise error
 
 
 def fetch_remote_config():
@@ -59,28 +165,89 @@ def fetch_remote_config():
         dict: The Remote Config template if successful, None otherwise
 
     Note:
-        Prints error messages to console if the request fails
+        - Prints error messages to console if the request fails
+        - Sends a hedged backup request when REMOTE_CONFIG_HEDGED_REQUESTS is enabled
     """
     headers = {
         'Authorization': f'Bearer {get_access_token()}',
         'Accept-Encoding': 'gzip',
         'X-goog-user-project': PROJECT_ID
     }
-    resp = requests.get(REMOTE_CONFIG_URL, headers=headers)
+    if REMOTE_CONFIG_HEDGED_REQUESTS:
+        resp = hedged_get(REMOTE_CONFIG_URL, headers, REMOTE_CONFIG_HEDGE_DELAY)
+    else:
+        resp = _rc_session.get(REMOTE_CONFIG_URL, headers=headers)
     if resp.status_code == 200:
-        return resp.json()
+        return orjson.loads(resp.content)
     else:
         print('Unable to get template')
         print(resp.text)
         return None
 
 
+def parse_remote_config(config):
+    """
+    Flatten a Remote Config template into cache entries.
+
+    Args:
+        config (dict): The Remote Config template returned by fetch_remote_config
+
+    Returns:
+        dict: Parameter values keyed by "group:key"
+
+    Note:
+        JSON values are automatically parsed into Python objects
+    """
+    values = {}
+    for group_name, group_data in config.get('parameterGroups', {}).items():
+        for param_key, param_value in group_data.get('parameters', {}).items():
+            cache_key = f"{group_name}:{param_key}"
+            if param_value['valueType'] == 'JSON':
+                values[cache_key] = orjson.loads(param_value['defaultValue']['value'])
+            else:
+                values[cache_key] = param_value['defaultValue']['value']
+    return values
+
+
+def reload_remote_config():
+    """
+    Fetch the Remote Config template and swap it into the cache.
+
+    Returns:
+        bool: True if the template was loaded, False otherwise
+
+    Note:
+        The new values replace the cache in a single assignment, so concurrent readers
+        see either the old or the new template
+    """
+    global remote_config_cache
+    with _rc_refresh_lock:
+        config = fetch_remote_config()
+        if not config:
+            return False
+        remote_config_cache = parse_remote_config(config)
+        _rc_ready.set()
+        return True
+
+
+def _background_refresher():
+    """Keep the Remote Config cache warm, reloading it shortly before it would expire."""
+    while True:
+        try:
+            loaded = reload_remote_config()
+        except Exception as e:
+            print(f"Error refreshing Remote Config: {e}")
+            loaded = False
+        time.sleep(REMOTE_CONFIG_CACHE_DURATION - REMOTE_CONFIG_REFRESH_MARGIN if loaded
+                   else REMOTE_CONFIG_RETRY_INTERVAL)
+
+
 def get_remote_config_value(parameter_group, key):
     """
-    Retrieve a value from Remote Config with caching.
+    Retrieve a value from the Remote Config cache.
 
-    Fetches and caches Remote Config values, refreshing the cache when expired.
-    Supports both JSON and string values from the Remote Config template.
+    Values are kept fresh by a background thread, so this is normally a dictionary
+    lookup. Supports both JSON and string values from the Remote Config template.
 
     Args:
         parameter_group (str): The parameter group name in Remote Config
@@ -90,28 +257,26 @@ def get_remote_config_value(parameter_group, key):
         Any: The configuration value for the specified key, or None if not found
 
     Note:
-        - Uses a global cache that expires after REMOTE_CONFIG_CACHE_DURATION seconds
+        - If the template has not been loaded yet, it is fetched before returning
         - JSON values are automatically parsed into Python objects
     """
-    global remote_config_last_fetch
-    current_time = time.time()
+    if not _rc_ready.is_set():
+        # Cold start: the background refresher has not loaded the template yet
+        with _rc_refresh_lock:
+            if not _rc_ready.is_set():
+                reload_remote_config()
+
+    return remote_config_cache.get(f"{parameter_group}:{key}")
 
-    # Check if cache needs refresh
-    if current_time - remote_config_last_fetch > REMOTE_CONFIG_CACHE_DURATION:
-        config = fetch_remote_config()
-        if config and 'parameterGroups' in config:
-            for group_name, group_data in config['parameterGroups'].items():
-                if 'parameters' in group_data:
-                    for param_key, param_value in group_data['parameters'].items():
-                        cache_key = f"{group_name}:{param_key}"
-                        if param_value['valueType'] == 'JSON':
-                            remote_config_cache[cache_key] = json.loads(param_value['defaultValue']['value'])
-                        else:
-                            remote_config_cache[cache_key] = param_value['defaultValue']['value']
-        remote_config_last_fetch = current_time
 
-    cache_key = f"{parameter_group}:{key}"
-    return remote_config_cache.get(cache_key)
+def _download_prompt(file_name, bucket_name):
+    """Download a prompt file from Google Cloud Storage and cache it."""
+    bucket = get_bucket(bucket_name)
+    blob = bucket.blob(f"shared/prompts/{file_name}")
+    prompt = blob.download_as_text()
+    with _cache_lock:
+        gcs_prompt_cache[file_name] = prompt
+    return prompt
 
 
 def get_gcs_prompt(file_name, bucket_name: Optional[str] = None):
@@ -126,18 +291,38 @@ def get_gcs_prompt(file_name, bucket_name: Optional[str] = None):
         str: Content of the prompt file
 
     Note:
-        - Caches prompt content in memory to avoid repeated storage access
+        - Caches prompt content in memory for GCS_PROMPT_CACHE_DURATION seconds
+        - Concurrent requests for the same uncached prompt share a single download
         - Prompt files should be stored in 'shared/prompts/' directory in the bucket
     """
     if not bucket_name:
         bucket_name = os.getenv("GOOGLE_CLOUD_BUCKET")
 
-    if file_name not in gcs_prompt_cache:
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(f"shared/prompts/{file_name}")
-        gcs_prompt_cache[file_name] = blob.download_as_text()
-    return gcs_prompt_cache[file_name]
+    with _cache_lock:
+        prompt = gcs_prompt_cache.get(file_name, _MISSING)
+    if prompt is not _MISSING:
+        return prompt
+
+    # The first thread to miss downloads the prompt; the others wait for it
+    with _prompt_downloads_lock:
+        download = _prompt_downloads.get(file_name)
+        is_downloader = download is None
+        if is_downloader:
+            download = _prompt_downloads[file_name] = threading.Event()
+
+    if not is_downloader:
+        download.wait()
+        with _cache_lock:
+            prompt = gcs_prompt_cache.get(file_name, _MISSING)
+        # Download it ourselves if the other thread's download failed
+        return prompt if prompt is not _MISSING else _download_prompt(file_name, bucket_name)
+
+    try:
+        return _download_prompt(file_name, bucket_name)
+    finally:
+        with _prompt_downloads_lock:
+            del _prompt_downloads[file_name]
+        download.set()
 
 
 def generate_decorator(parameter_group, endpoint_key):
@@ -188,3 +373,7 @@ def generate_decorator(parameter_group, endpoint_key):
         return decorated_function
 
     return decorator
+
+
+# Load the Remote Config template in the background as soon as the module is imported
+threading.Thread(target=_background_refresher, name="remote-config-refresher", daemon=True).start()
@@ -1,11 +1,42 @@
-import json
+import orjson
 import os
-from google.cloud import firestore, storage
+from concurrent.futures import Future, ThreadPoolExecutor
+from google.cloud import firestore
 from google.cloud import tasks_v2
 from flask import jsonify
 from firebase_admin import auth
+from secrets import token_hex
 from typing import Any, Dict, List, Optional
-from uuid import uuid4
+
+from src.clients.google_cloud import (
+    FIRESTORE_BATCH_LIMIT,
+    get_bucket,
+    get_firestore_client,
+    get_tasks_client
+)
+
+# Bucket holding uploaded media, read once at import
+BUCKET_NAME = os.getenv("GOOGLE_CLOUD_BUCKET")
+
+# Cloud Tasks queue and the Cloud Run URL tasks are sent to, built once at import
+CLOUD_TASKS_PARENT = tasks_v2.CloudTasksClient.queue_path(
+    os.getenv("GOOGLE_CLOUD_PROJECT"),
+    os.getenv("CLOUD_TASKS_QUEUE_REGION"),
+    os.getenv("CLOUD_TASKS_QUEUE")
+)
+INSTANCE_URL_BASE = (f'https://{os.getenv("K_SERVICE")}-{os.getenv("GOOGLE_CLOUD_PROJECT_NUMBER")}'
+                     f'.{os.getenv("GOOGLE_CLOUD_REGION")}.run.app')
+
+# Blobs requested per page when listing uploaded media, and the only fields we read
+LIST_BLOBS_PAGE_SIZE = 1000
+LIST_BLOBS_FIELDS = 'items(name,contentType,size),nextPageToken'
+
+# Executor for Firestore writes that should not block request processing
+_firestore_executor = ThreadPoolExecutor(max_workers=4)
+
+# Executor for committing Firestore batches concurrently when an update spans several.
+# Kept separate from _firestore_executor, whose workers block on these commits.
+_commit_executor = ThreadPoolExecutor(max_workers=4)
 
 
 def verify_auth_token(request):
@@ -21,19 +52,19 @@ def verify_auth_token(request):
             - A JSON response with error message and appropriate HTTP status code (401) if verification fails
 
     Raises:
-        IndexError: When the authorization header format is invalid
         InvalidIdTokenError: When the provided token is invalid
     """
     auth_header = request.headers.get('Authorization')
     if not auth_header:
         return jsonify({'error': 'No authorization token provided'}), 401
 
+    # Extract the token from 'Bearer <token>' format
+    auth_token = auth_header.partition(' ')[2]
+    if not auth_token:
+        return jsonify({'error': 'Invalid authorization header format'}), 401
+
     try:
-        # Extract the token from 'Bearer <token>' format
-        auth_token = auth_header.split(' ')[1]
         return auth.verify_id_token(auth_token)
-    except IndexError:
-        return jsonify({'error': 'Invalid authorization header format'}), 401
     except auth.InvalidIdTokenError:
         return jsonify({'error': 'Invalid authorization token'}), 401
 
@@ -55,11 +86,11 @@ def parse_json_data(request):
     """
     if 'json' in request.files:
         json_file = request.files['json']
-        json_data = json_file.read().decode('utf-8')
-        return json.loads(json_data) if json_data else {}
+        json_data = json_file.read()
+        return orjson.loads(json_data) if json_data else {}
     elif 'json' in request.form:
         json_data = request.form.get('json')
-        return json.loads(json_data) if json_data else {}
+        return orjson.loads(json_data) if json_data else {}
     else:
         return request.json or {}
 
@@ -80,22 +111,25 @@ def check_uploaded_media(user_id, chat_id, message_id):
             - fileSize: Size of the file in bytes
             - gcsPath: Complete Google Cloud Storage path
     """
-    bucket_name = os.getenv("GOOGLE_CLOUD_BUCKET")
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
+    bucket_name = BUCKET_NAME
+    bucket = get_bucket(bucket_name)
 
     # Construct the prefix for the user's media files
     prefix = f"users/{user_id}/chats/{chat_id}/uploadedMedia/{message_id}/"
-    blobs = bucket.list_blobs(prefix=prefix)
 
-    uploaded_files = []
-    for blob in blobs:
-        uploaded_files.append({
-            "fileName": blob.name.split('/')[-1],
+    # Use large pages and a partial response so listing takes as few, small round-trips as possible
+    blobs = bucket.list_blobs(prefix=prefix, page_size=LIST_BLOBS_PAGE_SIZE, fields=LIST_BLOBS_FIELDS)
+
+    gs_prefix = f"gs://{bucket_name}/"
+    uploaded_files = [
+        {
+            "fileName": blob.name.rpartition('/')[2],
             "fileMimeType": blob.content_type,
             "fileSize": blob.size,
-            "gcsPath": f"gs://{bucket_name}/{blob.name}"
-        })
+            "gcsPath": gs_prefix + blob.name
+        }
+        for blob in blobs
+    ]
 
     return uploaded_files
 
@@ -113,7 +147,7 @@ def create_cloud_task(url, payload, **kwargs):
         str: The name/ID of the created task
 
     Note:
-        Requires the following environment variables:
+        Requires the following environment variables, read once at import:
         - GOOGLE_CLOUD_PROJECT: Project ID
         - GOOGLE_CLOUD_REGION: Project region
         - GOOGLE_CLOUD_PROJECT_NUMBER: Project number
@@ -121,34 +155,24 @@ def create_cloud_task(url, payload, **kwargs):
         - CLOUD_TASKS_QUEUE_REGION: Queue region
         - K_SERVICE: Cloud Run instance name
     """
-    client = tasks_v2.CloudTasksClient()
-
-    # Get configuration from environment variables
-    project_id = os.getenv("GOOGLE_CLOUD_PROJECT")
-    project_region = os.getenv("GOOGLE_CLOUD_REGION")
-    project_number = os.getenv("GOOGLE_CLOUD_PROJECT_NUMBER")
-    queue = os.getenv("CLOUD_TASKS_QUEUE")
-    queue_region = os.getenv("CLOUD_TASKS_QUEUE_REGION")
-    instance_name = os.getenv("K_SERVICE")
-
-    parent = client.queue_path(project_id, queue_region, queue)
+    client = get_tasks_client()
 
     # Merge additional kwargs with the main payload
     task_payload = {**payload, **kwargs}
 
     # Construct the full Cloud Run instance URL
-    instance_url = f'https://{instance_name}-{project_number}.{project_region}.run.app{url}'
+    instance_url = INSTANCE_URL_BASE + url
 
     task = {
         'http_request': {
             'http_method': tasks_v2.HttpMethod.POST,
             'url': instance_url,
-            'body': json.dumps(task_payload).encode(),
+            'body': orjson.dumps(task_payload),
             'headers': {'Content-Type': 'application/json'}
         }
     }
 
-    response = client.create_task(request={'parent': parent, 'task': task})
+    response = client.create_task(request={'parent': CLOUD_TASKS_PARENT, 'task': task})
     return response.name
 
 
@@ -182,13 +206,26 @@ def update_firestore(
         DocumentReference: Reference to the updated chat document
 
     Note:
-        - Uses batch operations for efficient updates of claims and language instances
-        - Automatically generates UUIDs for new messages and instances
+        - Writes the chat update, answer message, claims and language instances in a
+          single batch, splitting it only when it exceeds FIRESTORE_BATCH_LIMIT writes
+        - Automatically generates random hex IDs for new messages and instances
         - Updates timestamps using Firestore server timestamp
     """
-    db = firestore.Client()
+    db = get_firestore_client()
     chat_ref = db.collection('users').document(user_id).collection('chats').document(chat_history_id)
 
+    # Every write goes into as few batches as the Firestore batch limit allows
+    batches = []
+    write_count = 0
+
+    def next_batch():
+        """Get the batch for the next write, starting a new one when the current one is full."""
+        nonlocal write_count
+        if write_count % FIRESTORE_BATCH_LIMIT == 0:
+            batches.append(db.batch())
+        write_count += 1
+        return batches[-1]
+
     # Prepare the base update data
     update_data = {
         'updatedAt': firestore.SERVER_TIMESTAMP,
@@ -198,8 +235,8 @@ def update_firestore(
     # Handle message creation if output text is provided
     if output_text:
         messages_ref = chat_ref.collection('messages')
-        answer_id = str(uuid4())
-        messages_ref.document(answer_id).set({
+        answer_id = token_hex(16)
+        next_batch().set(messages_ref.document(answer_id), {
             'id': answer_id,
             'content': output_text,
             'type': 'answer',
@@ -210,38 +247,60 @@ def update_firestore(
 
     # Update processing status
     update_data['status'] = 'completed' if is_final_update else 'processing'
-    chat_ref.update(update_data)
+    next_batch().update(chat_ref, update_data)
 
     # Batch update processed claims if provided
     if processed_claims:
         claims_ref = chat_ref.collection('processed_claims')
-        batch = db.batch()
         for claim in processed_claims:
-            claim_id = claim.get('id') or str(uuid4())
+            claim_id = claim.get('id') or token_hex(16)
             claim['id'] = claim_id
             doc_ref = claims_ref.document(claim_id)
-            batch.set(doc_ref, {
+            next_batch().set(doc_ref, {
                 'id': claim_id,
                 'claim_data': claim,
                 'style_mode': style_mode,
                 'timestamp': firestore.SERVER_TIMESTAMP
             }, merge=True)
-        batch.commit()
 
     # Batch update imprecise language instances if provided
     if processed_imprecise_language_instances:
         imprecise_lang_ref = chat_ref.collection('imprecise_language_instances')
-        batch = db.batch()
         for instance in processed_imprecise_language_instances:
-            instance_id = instance.get('id') or str(uuid4())
+            instance_id = instance.get('id') or token_hex(16)
             instance['id'] = instance_id
             doc_ref = imprecise_lang_ref.document(instance_id)
-            batch.set(doc_ref, {
+            next_batch().set(doc_ref, {
                 'id': instance_id,
                 'instance_data': instance,
                 'style_mode': style_mode,
                 'timestamp': firestore.SERVER_TIMESTAMP
             }, merge=True)
-        batch.commit()
+
+    # Usually a single commit; batches beyond the limit are committed concurrently
+    if len(batches) == 1:
+        batches[0].commit()
+    else:
+        commits = [_commit_executor.submit(batch.commit) for batch in batches]
+        for commit in commits:
+            commit.result()
 
     return chat_ref
+
+
+def submit_firestore_update(*args, **kwargs) -> Future:
+    """
+    Run update_firestore in the background.
+
+    Args:
+        *args: Positional arguments forwarded to update_firestore
+        **kwargs: Keyword arguments forwarded to update_firestore
+
+    Returns:
+        Future: Future resolving to the DocumentReference returned by update_firestore
+
+    Note:
+        Callers must wait on the returned future before issuing a later update for the
+        same chat, so that partial updates never land after the final one
+    """
+    return _firestore_executor.submit(update_firestore, *args, **kwargs)
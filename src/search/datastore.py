@@ -1,4 +1,3 @@
-from collections import OrderedDict
 from google.api_core.client_options import ClientOptions
 from google.cloud import discoveryengine_v1 as discoveryengine
 from typing import List, Optional
@@ -79,16 +78,17 @@ def search_datastore(
 
 def extract_relevant_documents_and_pages(response):
     """Extract relevant documents and pages."""
-    relevant_documents_and_pages_dict = OrderedDict()
+    relevant_documents_and_pages_dict = {}
     for result in response.results:
-        struct_data = dict(result.document.derived_struct_data)
+        # Read the three fields straight from the struct instead of copying it into a dict
+        struct_data = result.document.derived_struct_data
         link = struct_data["link"]
         html_title = struct_data.get("htmlTitle")
         title = struct_data.get("title")
-        output_dict = {}
-        output_dict["title"] = title
-        output_dict["html_title"] = html_title
-        output_dict["link"] = link
-        relevant_documents_and_pages_dict[title or html_title or link] = output_dict
+        relevant_documents_and_pages_dict[title or html_title or link] = {
+            "title": title,
+            "html_title": html_title,
+            "link": link
+        }
 
     return relevant_documents_and_pages_dict